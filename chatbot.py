@@ -1,18 +1,26 @@
 import os
 import io
-import base64
+import re
+import importlib.util
+import hashlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 
 import streamlit as st
 import google.generativeai as genai
 
-# Optional speech: local TTS via gTTS (requires internet)
+# Optional speech: local TTS via gTTS (requires internet). Only probed here;
+# the import itself is deferred until speech is first requested.
+GTTS_AVAILABLE = importlib.util.find_spec("gtts") is not None
+
+# Optional batch reruns: the Batch API lives in the newer google-genai SDK
 try:
-    from gtts import gTTS
-    GTTS_AVAILABLE = True
+    from google import genai as google_genai
+    BATCH_AVAILABLE = True
 except Exception:
-    GTTS_AVAILABLE = False
+    BATCH_AVAILABLE = False
 
 # ------------- CONFIG -------------
 TEXT_MODEL = "gemini-flash-latest"     # works for your key per your list_models
@@ -21,6 +29,22 @@ MAX_OUTPUT_TOKENS = 512
 TEMPERATURE = 0.9
 TOP_P = 0.95
 
+RESPONSE_CACHE_TTL = 3600     # seconds a memoized reply stays valid
+RESPONSE_CACHE_ENTRIES = 256  # bound on memoized replies kept in RAM
+MODEL_CACHE_ENTRIES = 16      # bound on shared GenerativeModel instances
+UPLOAD_CACHE_TTL = 300        # seconds an upload's bytes stay cached
+UPLOAD_CACHE_ENTRIES = 4      # raw uploads kept in RAM across all sessions
+MAX_HISTORY_TURNS = 40        # messages kept in st.session_state.chat
+MAX_INPUT_TOKENS = 4096       # prompt budget for summary + recent turns + new message
+TOKEN_ESTIMATE_MARGIN = 512   # slack for media and tokenizer drift in the chars/4 estimate
+SUMMARY_TRIGGER_TURNS = 20    # unsummarized messages that trigger a background summary
+SUMMARY_KEEP_TURNS = 10       # most recent messages always sent verbatim
+SUMMARY_SYSTEM_PROMPT = "You condense chat transcripts into short factual summaries."
+MAX_CONCURRENT_GENERATIONS = 4  # process-wide cap on in-flight Gemini calls
+INLINE_MEDIA_LIMIT = 4 * 1024 * 1024  # larger attachments go through the File API
+BATCH_POLL_SECONDS = 60       # how often pending batch jobs are polled
+BATCH_FINAL_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
 PERSONAS = {
     "General (default)": "You are a helpful, concise assistant.",
     "Friendly Tutor": "You are a patient tutor who explains step-by-step with examples.",
@@ -51,69 +75,387 @@ section.main > div { padding-top: 1rem; }
 hr.soft { border: none; border-top: 1px solid rgba(255,255,255,0.08); margin: 0.75rem 0 1rem; }
 </style>
 """
+# Comments and whitespace runs stripped: this is re-sent with every rerun
+DARK_CSS_MIN = re.sub(r"\s+", " ", re.sub(r"/\*.*?\*/", "", DARK_CSS, flags=re.S)).strip()
 
 # ------------- HELPERS -------------
-def _require_key():
-    api_key = os.environ.get("GOOGLE_API_KEY")
-    if not api_key:
-        raise ValueError("Missing GOOGLE_API_KEY environment variable. Set it in your terminal.")
+@st.cache_resource(show_spinner=False)
+def _configure_genai(api_key: str):
+    """Configure the SDK once per process (and again only if the key changes)."""
     genai.configure(api_key=api_key)
 
-def _tts_to_bytes(text: str) -> Optional[bytes]:
-    """Return MP3 bytes from text using gTTS, or None if unavailable."""
-    if not GTTS_AVAILABLE:
-        return None
+@st.cache_resource(show_spinner=False)
+def _load_gtts():
+    """Import gTTS on first use; returns the gTTS class or None."""
     try:
-        tts = gTTS(text)
-        buf = io.BytesIO()
-        tts.write_to_fp(buf)
-        return buf.getvalue()
+        from gtts import gTTS
+        return gTTS
     except Exception:
         return None
 
-def _render_message(msg: Dict[str, Any]):
-    role = msg["role"]
-    content = msg["content"]
+@st.cache_data(ttl=24 * 60 * 60, max_entries=64, show_spinner=False)
+def _tts_to_bytes(text: str) -> Optional[bytes]:
+    """Return MP3 bytes from text using gTTS, or None if unavailable.
+
+    Memoized on `text`; gTTS errors propagate so a failed synthesis is not cached.
+    """
+    gTTS = _load_gtts() if GTTS_AVAILABLE else None
+    if gTTS is None:
+        return None
+    tts = gTTS(text)
+    buf = io.BytesIO()
+    tts.write_to_fp(buf)
+    return buf.getvalue()
+
+_FENCE_RE = re.compile(r"^ {0,3}(`{3,}|~{3,})(.*)$")
+
+def _close_open_fences(content: str) -> str:
+    """Close a code fence left open (e.g. a reply cut off at MAX_OUTPUT_TOKENS).
+
+    History bubbles share one markdown document, so an unclosed fence would
+    otherwise swallow every later bubble into a code block.
+    """
+    open_fence = None
+    for line in content.splitlines():
+        m = _FENCE_RE.match(line)
+        if not m:
+            continue
+        fence, rest = m.groups()
+        if open_fence is None:
+            if not (fence[0] == "`" and "`" in rest):
+                open_fence = fence
+        elif fence[0] == open_fence[0] and len(fence) >= len(open_fence) and not rest.strip():
+            open_fence = None
+    if open_fence is None:
+        return content
+    return f"{content}\n{open_fence}"
+
+def _write_message_html(buf: io.StringIO, msg: Dict[str, Any]):
+    """Append one chat bubble's HTML to `buf`."""
     time = msg.get("time")
-    meta = f"<div class='small'>{time}</div>" if time else ""
-    klass = "user" if role == "user" else "bot"
-    st.markdown(f"<div class='bubble {klass}'>{content}{meta}</div>", unsafe_allow_html=True)
-
-def _encode_download_bytes(name: str, data: bytes) -> str:
-    b64 = base64.b64encode(data).decode("utf-8")
-    return f"data:application/octet-stream;base64,{b64}"
-
-def _format_history_for_download(history: List[Dict[str, Any]]) -> str:
-    lines = []
-    for h in history:
-        t = h.get("time", "")
-        lines.append(f"[{t}] {h['role'].upper()}: {h['content']}")
-    return "\n".join(lines)
-
-def _make_parts_from_inputs(text: str, image_files, audio_file) -> List[Any]:
-    """Build parts list for multimodal request (text + optional image/audio)."""
-    parts = []
-    if text:
-        parts.append(text)
+    buf.write("<div class='bubble user'>" if msg["role"] == "user" else "<div class='bubble bot'>")
+    buf.write(_close_open_fences(msg["content"]))
+    # End on a line of its own so the closing tags never continue the message's
+    # last block (fence, indented code, list item) in the shared document
+    buf.write("\n")
+    if time:
+        buf.write("<div class='small'>")
+        buf.write(time)
+        buf.write("</div>")
+    buf.write("</div>")
+
+def _message_html(msg: Dict[str, Any]) -> str:
+    buf = io.StringIO()
+    _write_message_html(buf, msg)
+    return buf.getvalue()
+
+def _render_message(msg: Dict[str, Any], target=None):
+    """Render a chat bubble into `target` (an st.empty placeholder) or the main area."""
+    (target or st).markdown(_message_html(msg), unsafe_allow_html=True)
+
+def _render_history(history: List[Dict[str, Any]]):
+    """Render the whole history as one markdown element (one frontend delta, not one per message)."""
+    if history:
+        buf = io.StringIO()
+        buf.write("<div class='chat-wrap'>")
+        for m in history:
+            _write_message_html(buf, m)
+        buf.write("</div>")
+        st.markdown(buf.getvalue(), unsafe_allow_html=True)
+
+def _history_snapshot(history: List[Dict[str, Any]]) -> Tuple[Tuple[str, str, str], ...]:
+    """Hashable (role, content, time) snapshot of the chat, used as a cache key."""
+    return tuple((m["role"], m["content"], m.get("time", "")) for m in history)
+
+def _format_history_for_download(history: Tuple[Tuple[str, str, str], ...]) -> str:
+    buf = io.StringIO()
+    for i, (role, content, t) in enumerate(history):
+        if i:
+            buf.write("\n")
+        buf.write("[")
+        buf.write(t)
+        buf.write("] ")
+        buf.write(role.upper())
+        buf.write(": ")
+        buf.write(content)
+    return buf.getvalue()
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def _encode_history_txt(history_tuple: Tuple[Tuple[str, str, str], ...]) -> bytes:
+    return _format_history_for_download(history_tuple).encode("utf-8")
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def _encode_history_json(history_tuple: Tuple[Tuple[str, str, str], ...]) -> bytes:
+    import json
+    records = [{"role": role, "content": content, "time": t} for role, content, t in history_tuple]
+    return json.dumps(records, ensure_ascii=False, indent=2).encode("utf-8")
+
+@st.cache_resource(ttl=UPLOAD_CACHE_TTL, max_entries=UPLOAD_CACHE_ENTRIES, show_spinner=False)
+def _upload_bytes(file_id: str, _file) -> bytes:
+    """Bytes of an UploadedFile, keyed on Streamlit's file_id.
+
+    Rewinds first, so a stream already read to EOF still yields its content,
+    and the same upload on later reruns is served from cache. cache_resource
+    hands back the same immutable bytes object instead of unpickling a copy.
+    """
+    _file.seek(0)
+    return _file.read()
+
+def _read_media(image_files, audio_file) -> List[Tuple[str, bytes, bytes]]:
+    """Read every attachment once and return (mime_type, bytes, sha256 digest) triples."""
+    media = []
     if image_files:
         for f in image_files:
-            bytes_data = f.read()
-            parts.append({
-                "mime_type": f.type or "image/png",
-                "data": bytes_data
-            })
+            data = _upload_bytes(f.file_id, f)
+            media.append((f.type or "image/png", data, hashlib.sha256(data).digest()))
     if audio_file is not None:
-        bytes_data = audio_file.read()
         mime = getattr(audio_file, "type", None) or "audio/wav"
-        parts.append({
-            "mime_type": mime,
-            "data": bytes_data
-        })
+        data = _upload_bytes(audio_file.file_id, audio_file)
+        media.append((mime, data, hashlib.sha256(data).digest()))
+    return media
+
+def _uploaded_media(mime: str, bytes_data: bytes, digest: bytes):
+    """Upload large media once per session and reuse the File handle by content hash."""
+    uploads = st.session_state.setdefault("uploaded_media", {})
+    key = digest.hex()
+    if key not in uploads:
+        uploads[key] = genai.upload_file(io.BytesIO(bytes_data), mime_type=mime)
+    return uploads[key]
+
+def _make_parts_from_inputs(text: str, media: List[Tuple[str, bytes, bytes]]) -> List[Any]:
+    """Build parts list for multimodal request (text + optional image/audio)."""
+    parts = []
+    if text:
+        parts.append(text)
+    for mime, bytes_data, digest in media:
+        if len(bytes_data) > INLINE_MEDIA_LIMIT:
+            parts.append(_uploaded_media(mime, bytes_data, digest))
+        else:
+            # SDK-native Blob: no intermediate dict for the SDK to re-serialize
+            parts.append(genai.protos.Part(
+                inline_data=genai.protos.Blob(mime_type=mime, data=bytes_data)
+            ))
     return parts
 
+# No service_tier here: google.generativeai's GenerationConfig has no such
+# field (it raises "Unknown field"), so every call uses the standard tier.
+def _generation_config() -> Dict[str, Any]:
+    return {
+        "temperature": TEMPERATURE,
+        "top_p": TOP_P,
+        "max_output_tokens": MAX_OUTPUT_TOKENS
+    }
+
+@st.cache_resource(max_entries=MODEL_CACHE_ENTRIES, show_spinner=False)
+def _get_model(model_name: str, persona_prompt: str) -> genai.GenerativeModel:
+    """Shared GenerativeModel per (model, persona).
+
+    cache_resource keeps one instance across reruns and sessions, so a send
+    only pays for construction when one of the key arguments changes. The key
+    includes free-form custom prompts, hence the max_entries bound.
+    """
+    return genai.GenerativeModel(
+        model_name=model_name,
+        system_instruction=persona_prompt,
+        generation_config=_generation_config()
+    )
+
+@st.cache_resource(show_spinner=False)
+def _get_batch_client():
+    """Shared google-genai client for Batch API calls."""
+    return google_genai.Client(api_key=os.environ["GOOGLE_API_KEY"])
+
+def _build_batch_jsonl(history: List[Dict[str, Any]], persona_prompt: str) -> Tuple[bytes, Dict[str, str]]:
+    """One Batch API request per stored user turn; also returns key -> prompt."""
+    import json
+    lines, prompts = [], {}
+    for i, m in enumerate(history):
+        if m["role"] != "user":
+            continue
+        key = f"turn_{i}"
+        prompts[key] = m["content"]
+        lines.append(json.dumps({
+            "key": key,
+            "request": {
+                "system_instruction": {"parts": [{"text": persona_prompt}]},
+                "contents": [{"parts": [{"text": m["content"]}]}]
+            }
+        }, ensure_ascii=False))
+    return "\n".join(lines).encode("utf-8"), prompts
+
+def _submit_batch_rerun(history: List[Dict[str, Any]], persona_prompt: str) -> Optional[Dict[str, Any]]:
+    """Upload the rerun JSONL and create a batch job; None if there is nothing to send."""
+    data, prompts = _build_batch_jsonl(history, persona_prompt)
+    if not prompts:
+        return None
+    client = _get_batch_client()
+    uploaded = client.files.upload(
+        file=io.BytesIO(data),
+        config={"display_name": "chat-reruns", "mime_type": "jsonl"}
+    )
+    job = client.batches.create(model=TEXT_MODEL, src=uploaded.name, config={"display_name": "chat-reruns"})
+    return {"name": job.name, "state": job.state.name, "prompts": prompts, "results": []}
+
+def _parse_batch_results(raw: bytes, prompts: Dict[str, str]) -> List[Dict[str, str]]:
+    import json
+    results = []
+    for line in raw.decode("utf-8").splitlines():
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        try:
+            parts = row["response"]["candidates"][0]["content"]["parts"]
+            answer = "".join(p.get("text", "") for p in parts)
+        except (KeyError, IndexError):
+            answer = f"Error: {row.get('error', 'no response')}"
+        results.append({"prompt": prompts.get(row.get("key"), ""), "answer": answer})
+    return results
+
+def _poll_batch_job(job: Dict[str, Any]):
+    """Refresh a job's state in place and fetch its results once it succeeds."""
+    client = _get_batch_client()
+    remote = client.batches.get(name=job["name"])
+    job["state"] = remote.state.name
+    if job["state"] == "JOB_STATE_SUCCEEDED":
+        raw = client.files.download(file=remote.dest.file_name)
+        job["results"] = _parse_batch_results(raw, job["prompts"])
+
+@st.cache_resource
+def _generate_semaphore() -> threading.BoundedSemaphore:
+    """Limiter shared by every session.
+
+    Streamlit re-executes this script on each rerun, so a plain module-level
+    semaphore would be per-run; cache_resource makes it a process singleton.
+    """
+    return threading.BoundedSemaphore(value=MAX_CONCURRENT_GENERATIONS)
+
+@st.cache_resource
+def _inflight_requests() -> Tuple[threading.Lock, Dict[str, Future]]:
+    """Process-wide {request hash: Future} map used to coalesce identical sends."""
+    return threading.Lock(), {}
+
+def _history_contents(history: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Map stored turns to Gemini contents, dropping failed exchanges."""
+    contents = []
+    for m in history:
+        role = "user" if m["role"] == "user" else "model"
+        if role == "model" and m["content"].startswith("Error:"):
+            # Keep user/model alternation: drop the prompt that failed as well
+            if contents and contents[-1]["role"] == "user":
+                contents.pop()
+            continue
+        contents.append({"role": role, "parts": [m["content"]]})
+    return contents
+
+def _approx_tokens(contents: List[Dict[str, Any]]) -> int:
+    return sum(len(p) for c in contents for p in c["parts"] if isinstance(p, str)) // 4
+
+def _fit_token_budget(model: genai.GenerativeModel, contents: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Drop the oldest exchanges until the prompt fits MAX_INPUT_TOKENS.
+
+    The character-based estimate plus TOKEN_ESTIMATE_MARGIN counts as fitting.
+    Otherwise count_tokens, a round trip on the hot path, is called once; the
+    oldest turns are then dropped by subtracting their estimated size from it.
+    """
+    approx = _approx_tokens(contents)
+    if len(contents) <= 1 or approx + TOKEN_ESTIMATE_MARGIN <= MAX_INPUT_TOKENS:
+        return contents
+    try:
+        total = model.count_tokens(contents).total_tokens
+    except Exception:
+        total = approx + TOKEN_ESTIMATE_MARGIN
+    while len(contents) > 1 and total > MAX_INPUT_TOKENS:
+        total -= _approx_tokens([contents.pop(0)])
+        # Never start the prompt on a model turn
+        while len(contents) > 1 and contents[0]["role"] == "model":
+            total -= _approx_tokens([contents.pop(0)])
+    return contents
+
+def _summarize_turns(model: genai.GenerativeModel, semaphore: threading.BoundedSemaphore,
+                     previous_summary: str, turns: Tuple[Tuple[str, str, str], ...]) -> str:
+    """Fold `turns` into the running summary. Runs on the summary executor thread.
+
+    Holds the shared generation semaphore, so summaries count against the same
+    concurrency cap as interactive sends.
+    """
+    prompt = "Summarize concisely, keeping facts, names and decisions needed later.\n\n"
+    if previous_summary:
+        prompt += f"Summary so far:\n{previous_summary}\n\nNew turns:\n"
+    with semaphore:
+        response = model.generate_content(prompt + _format_history_for_download(turns))
+    return response.text.strip()
+
+@st.cache_resource
+def _summary_executor() -> ThreadPoolExecutor:
+    """Single background worker shared by all sessions for history summaries."""
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-summary")
+
+def _maybe_summarize():
+    """Start a background summary once enough turns have piled up past the last one."""
+    chat = st.session_state.chat
+    start = st.session_state.summarized_up_to
+    if st.session_state.get("summary_job") or len(chat) - start <= SUMMARY_TRIGGER_TURNS:
+        return
+    upto = len(chat) - SUMMARY_KEEP_TURNS
+    # Resolved here: cached accessors need the script context the worker lacks
+    model = _get_model(TEXT_MODEL, SUMMARY_SYSTEM_PROMPT)
+    future = _summary_executor().submit(
+        _summarize_turns, model, _generate_semaphore(), st.session_state.summary,
+        _history_snapshot(chat[start:upto])
+    )
+    st.session_state.summary_job = {"future": future, "upto": upto}
+
+def _collect_summary():
+    """Adopt a finished background summary; failed ones are retried on a later turn."""
+    job = st.session_state.get("summary_job")
+    if not job or not job["future"].done():
+        return
+    st.session_state.summary_job = None
+    try:
+        st.session_state.summary = job["future"].result()
+        st.session_state.summarized_up_to = job["upto"]
+    except Exception:
+        pass
+
+def _trim_history():
+    """Ring buffer over the chat; summary bookkeeping shifts with the dropped turns."""
+    dropped = len(st.session_state.chat) - MAX_HISTORY_TURNS
+    if dropped <= 0:
+        return
+    st.session_state.chat = st.session_state.chat[dropped:]
+    st.session_state.summarized_up_to = max(0, st.session_state.summarized_up_to - dropped)
+    job = st.session_state.get("summary_job")
+    if job:
+        job["upto"] = max(0, job["upto"] - dropped)
+
+class _GenerationCancelled(Exception):
+    """Set on an in-flight Future when its leading run was closed before finishing."""
+
+class _CacheMiss(Exception):
+    """Raised by _cached_generate when no reply is stored for the given inputs."""
+
+@st.cache_data(ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_ENTRIES, show_spinner=False)
+def _cached_generate(model_name: str, persona: str, text: str, media_blobs_tuple: tuple,
+                     gen_cfg_tuple: tuple, context_hash: str, _answer: Optional[str] = None) -> str:
+    """Memoized reply keyed on the request inputs (media and context enter as hashes only).
+
+    Called without `_answer` it is a lookup and raises _CacheMiss on a miss;
+    exceptions are never cached. Called with the streamed `_answer` it stores
+    it. `_answer` is underscore-prefixed so Streamlit leaves it out of the key.
+    """
+    if _answer is None:
+        raise _CacheMiss()
+    return _answer
+
 # ------------- APP -------------
 st.set_page_config(page_title="AI Chatbot 😎 using Google Gemini", layout="centered")
-st.markdown(DARK_CSS, unsafe_allow_html=True)
+
+if not os.environ.get("GOOGLE_API_KEY"):
+    st.error("Missing GOOGLE_API_KEY environment variable. Set it in your terminal.")
+    st.stop()
+_configure_genai(os.environ["GOOGLE_API_KEY"])
+
+st.markdown(DARK_CSS_MIN, unsafe_allow_html=True)
 st.title("AI Chatbot 😎 using Google Gemini")
 
 with st.sidebar:
@@ -127,9 +469,24 @@ with st.sidebar:
     tts_enabled = st.toggle("Speak responses (gTTS)", value=False)
     st.caption("If mic is off or unsupported, you can still upload audio files below.")
 
+    st.subheader("Batch 📦")
+    if st.button("Queue reruns under new persona", disabled=not BATCH_AVAILABLE):
+        try:
+            job = _submit_batch_rerun(st.session_state.get("chat", []), system_prompt)
+            if job is None:
+                st.info("No user turns to rerun yet.")
+            else:
+                st.session_state.setdefault("batch_jobs", []).append(job)
+                st.toast("Batch job queued.")
+        except Exception as e:
+            st.error(f"Could not queue batch job: {e}")
+    st.caption("Batch mode is half price with up to 24h turnaround." if BATCH_AVAILABLE
+               else "Install google-genai to enable batch reruns.")
+
     st.subheader("History 💾")
     if st.button("Clear chat history", type="secondary"):
-        st.session_state.pop("chat", None)
+        for key in ("chat", "summary", "summarized_up_to", "summary_job"):
+            st.session_state.pop(key, None)
         st.toast("History cleared.")
 
 # session state
@@ -137,6 +494,10 @@ if "chat" not in st.session_state:
     st.session_state.chat: List[Dict[str, Any]] = []
 if "persona_prompt" not in st.session_state:
     st.session_state.persona_prompt = system_prompt
+if "summary" not in st.session_state:
+    st.session_state.summary = ""
+    st.session_state.summarized_up_to = 0
+_collect_summary()
 
 # Update persona prompt live
 st.session_state.persona_prompt = system_prompt
@@ -163,37 +524,99 @@ with media_cols[2]:
 st.markdown("<hr class='soft'/>", unsafe_allow_html=True)
 
 # --- SHOW HISTORY ---
-for m in st.session_state.chat:
-    _render_message(m)
-
-def run_model(text: str, images_files, audio_file):
-    _require_key()
+# Slots for the turn being sent are created up front so the send handler can
+# fill them in place instead of rerunning the whole script.
+history_placeholder = st.container()
+new_msg_placeholder = st.empty()
+reply_placeholder = st.empty()
+with history_placeholder:
+    _render_history(st.session_state.chat)
+
+def run_model(text: str, images_files, audio_file) -> Iterator[str]:
+    """Yield the reply text chunk by chunk as Gemini streams it back.
+
+    The prompt is the running summary plus the unsummarized turns before the
+    message just appended to st.session_state.chat, then the new message.
+    """
     use_multimodal = (images_files and len(images_files) > 0) or (audio_file is not None)
     model_name = MULTIMODAL_MODEL if use_multimodal else TEXT_MODEL
+    persona = st.session_state.persona_prompt
+    text = text if use_multimodal else (text or "Say hello!")
 
-    model = genai.GenerativeModel(
-        model_name=model_name,
-        system_instruction=st.session_state.persona_prompt,
-        generation_config={
-            "temperature": TEMPERATURE,
-            "top_p": TOP_P,
-            "max_output_tokens": MAX_OUTPUT_TOKENS
-        }
-    )
+    generation_config = _generation_config()
 
-    if use_multimodal:
-        parts = _make_parts_from_inputs(text, images_files, audio_file)
-        response = model.generate_content(parts)
-    else:
-        response = model.generate_content(text or "Say hello!")
+    # Read the attachments once; the memo key only sees their hashes
+    media = _read_media(images_files, audio_file) if use_multimodal else []
+    media_blobs_tuple = tuple((mime, digest) for mime, _, digest in media)
 
-    text_out = getattr(response, "text", None)
-    if not text_out:
+    summary = st.session_state.summary
+    context = _history_contents(st.session_state.chat[st.session_state.summarized_up_to:-1])
+    context_hash = hashlib.sha256(repr((summary, context)).encode("utf-8")).hexdigest()
+    cache_key = (model_name, persona, text, media_blobs_tuple,
+                 tuple(sorted(generation_config.items())), context_hash)
+    try:
+        cached = _cached_generate(*cache_key)
+    except _CacheMiss:
+        cached = None
+    if cached is not None:
+        yield cached
+        return
+
+    # Coalesce with an identical request already streaming in another session
+    key = hashlib.sha256(repr(cache_key).encode("utf-8")).hexdigest()
+    lock, inflight = _inflight_requests()
+    while True:
+        with lock:
+            existing = inflight.get(key)
+            if existing is None:
+                future = inflight[key] = Future()
+        if existing is None:
+            break
         try:
-            text_out = response.candidates[0].content.parts[0].text
-        except Exception:
-            text_out = str(response)
-    return text_out
+            answer = existing.result()
+        except _GenerationCancelled:
+            # The leading session was interrupted (e.g. a rerun), not failed:
+            # take over as the new caller instead of surfacing its cancellation
+            continue
+        yield answer
+        return
+
+    buf = []
+    try:
+        model = _get_model(model_name, persona)
+
+        # Held until the stream is drained: the HTTP stream is the expensive part
+        with _generate_semaphore():
+            parts = _make_parts_from_inputs(text, media) if use_multimodal else [text]
+            if summary:
+                parts.insert(0, f"Summary of the earlier conversation:\n{summary}")
+            contents = _fit_token_budget(model, context + [{"role": "user", "parts": parts}])
+            response = model.generate_content(contents, stream=True)
+
+            for chunk in response:
+                try:
+                    text_out = chunk.text
+                except Exception:
+                    # Chunks without text (e.g. safety metadata only) carry nothing to show.
+                    text_out = ""
+                if text_out:
+                    buf.append(text_out)
+                    yield text_out
+    except BaseException as e:
+        # Unregister before resolving so a retrying waiter never sees this Future
+        # again; waiters must never hang, even if this generator is closed early
+        with lock:
+            inflight.pop(key, None)
+        future.set_exception(e if isinstance(e, Exception) else _GenerationCancelled())
+        raise
+    else:
+        answer = "".join(buf)
+        with lock:
+            inflight.pop(key, None)
+        future.set_result(answer)
+        # Only complete, non-empty replies are memoized
+        if answer:
+            _cached_generate(*cache_key, _answer=answer)
 
 # --- SEND HANDLER ---
 if send_clicked:
@@ -207,20 +630,36 @@ if send_clicked:
         if audio_upload or mic_audio:
             preview += "\n\n🎙️ audio attached"
 
-        st.session_state.chat.append({"role": "user", "content": preview.strip(), "time": stamp})
-        with st.spinner("Thinking..."):
-            try:
-                audio_source = mic_audio if mic_audio is not None else audio_upload
-                answer = run_model(user_text, images, audio_source)
-            except Exception as e:
-                answer = f"Error: {e}"
-
-        st.session_state.chat.append({
+        user_msg = {"role": "user", "content": preview.strip(), "time": stamp}
+        st.session_state.chat.append(user_msg)
+        _render_message(user_msg, target=new_msg_placeholder)
+
+        # Stream the reply into its placeholder; it already shows the final
+        # content, so no st.rerun() is needed afterwards.
+        placeholder = reply_placeholder
+        # Visible until the first chunk lands (queueing, token counting, or
+        # waiting on an identical request from another session)
+        _render_message({"role": "assistant", "content": "Thinking…"}, target=placeholder)
+        buf = []
+        try:
+            audio_source = mic_audio if mic_audio is not None else audio_upload
+            for chunk in run_model(user_text, images, audio_source):
+                buf.append(chunk)
+                _render_message({"role": "assistant", "content": "".join(buf)}, target=placeholder)
+            answer = "".join(buf) or "(no response)"
+        except Exception as e:
+            answer = f"Error: {e}"
+
+        bot_msg = {
             "role": "assistant",
             "content": answer,
             "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        })
-        st.rerun()
+        }
+        st.session_state.chat.append(bot_msg)
+        # Ring buffer: rendering, downloads and the prompt stay bounded per turn
+        _trim_history()
+        _maybe_summarize()
+        _render_message(bot_msg, target=placeholder)
 
 # --- TOOLBAR: SAVE / DOWNLOAD / TTS ---
 st.markdown("<hr class='soft'/>", unsafe_allow_html=True)
@@ -228,25 +667,65 @@ st.write("### Tools")
 
 tool_c1, tool_c2, tool_c3 = st.columns([1, 1, 2])
 
+history_snapshot = _history_snapshot(st.session_state.chat)
+
 with tool_c1:
-    if st.button("Download .txt"):
-        txt = _format_history_for_download(st.session_state.chat).encode("utf-8")
-        st.download_button("Save Chat (.txt)", data=txt, file_name="chat_history.txt", mime="text/plain")
+    st.download_button(
+        "Save Chat (.txt)",
+        data=_encode_history_txt(history_snapshot),
+        file_name="chat_history.txt",
+        mime="text/plain",
+        on_click="ignore",
+    )
 
 with tool_c2:
-    if st.button("Download .json"):
-        import json
-        js = json.dumps(st.session_state.chat, ensure_ascii=False, indent=2).encode("utf-8")
-        st.download_button("Save Chat (.json)", data=js, file_name="chat_history.json", mime="application/json")
+    st.download_button(
+        "Save Chat (.json)",
+        data=_encode_history_json(history_snapshot),
+        file_name="chat_history.json",
+        mime="application/json",
+        on_click="ignore",
+    )
 
 with tool_c3:
     if st.session_state.chat and GTTS_AVAILABLE and st.toggle("Read last reply aloud", value=False):
         last = next((m for m in reversed(st.session_state.chat) if m["role"] == "assistant"), None)
         if last:
-            mp3 = _tts_to_bytes(last["content"])
+            try:
+                mp3 = _tts_to_bytes(last["content"])
+            except Exception:
+                mp3 = None
             if mp3:
                 st.audio(mp3, format="audio/mp3")
             else:
                 st.info("Could not synthesize speech (gTTS unavailable or failed).")
 
+def _batch_jobs_pending() -> bool:
+    return any(job["state"] not in BATCH_FINAL_STATES for job in st.session_state.get("batch_jobs", []))
+
+# The timer only runs while some job can still change state; tabs without
+# pending jobs (or without google-genai) never rerun the fragment
+@st.fragment(run_every=BATCH_POLL_SECONDS if _batch_jobs_pending() else None)
+def _batch_results_panel():
+    """Poll pending batch jobs on a timer without rerunning the whole script."""
+    jobs = st.session_state.get("batch_jobs", [])
+    if not jobs:
+        return
+    was_pending = _batch_jobs_pending()
+    with st.expander("Batch results", expanded=False):
+        for job in jobs:
+            if job["state"] not in BATCH_FINAL_STATES:
+                try:
+                    _poll_batch_job(job)
+                except Exception as e:
+                    st.warning(f"Could not poll {job['name']}: {e}")
+            st.caption(f"{job['name']} — {job['state']}")
+            for r in job["results"]:
+                st.markdown(f"**{r['prompt']}**\n\n{r['answer']}")
+    if was_pending and not _batch_jobs_pending():
+        # Last job just finished: rerun the app once so the timer is dropped
+        st.rerun()
+
+_batch_results_panel()
+
 st.markdown("</div>", unsafe_allow_html=True)